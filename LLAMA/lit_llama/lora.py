@@ -151,14 +151,13 @@ class MergedLinear(nn.Linear, LoRALayer):
                 self.weight.new_zeros((r * sum(enable_lora), in_features)))  # (4, 128)
             self.lora_B = nn.Parameter(
                 self.weight.new_zeros((out_features // len(enable_lora) * sum(enable_lora), r))  # (256, 2)
-            ) # weights for Conv1D with groups=sum(enable_lora)
+            ) # one (128, 2) block per enabled matrix
             # Notes about shapes above
             # - self.lora_A has shape (4, 128): 4 because rank is 2 and LoRA is applied only to two matrices;
             # 128 is the input size of the x (embedding size). (4, 128) and not (128, 4) because later on in
-            # F.linear function weights are automatically transposed. In addition conv1d requires channels to
-            # be before seq length
+            # F.linear function weights are automatically transposed
             # - self.lora_B has shape (256, 2): 256 because LoRA is applied only to two matrices, so the output is
-            # 128*2; 2 tells to have two channels per group for group convolution
+            # 128*2; rows [0, 128) are multiplied with rows [0, 2) of lora_A, rows [128, 256) with rows [2, 4)
 
             # Scaling:
             # This balances the pretrained model`s knowledge and the new task-specific adaptation
@@ -188,6 +187,15 @@ class MergedLinear(nn.Linear, LoRALayer):
             ).view(len(enable_lora), -1)  # (3, 128)
             self.lora_ind[enable_lora, :] = True  # (3, 128)
             self.lora_ind = self.lora_ind.view(-1)  # (384,)
+
+            # Integer indices that scatter the rows of lora_B into the block diagonal matrix of `_lora_B_block`,
+            # viewed as (out_features * n_groups, r): row i of lora_B belongs to the group i // 128 and is the
+            # update of the output feature `rows[i]`. Computed once, so no boolean mask indexing (and no
+            # device->host sync) happens in forward
+            n_groups = sum(enable_lora)
+            rows = torch.arange(out_features, device=self.weight.device).view(len(enable_lora), -1)[enable_lora]  # (2, 128)
+            groups = torch.arange(n_groups, device=self.weight.device).view(-1, 1)  # (2, 1)
+            self.register_buffer('lora_B_index', (rows * n_groups + groups).view(-1), persistent=False)  # (256,)
         self.reset_parameters()
         if fan_in_fan_out:
             self.weight.data = self.weight.data.T
@@ -233,6 +241,27 @@ class MergedLinear(nn.Linear, LoRALayer):
         )  # (4096, 256)
         return result.view((*x.shape[:-1], self.out_features)).transpose(0, 1)  # (64, 64, 384)
 
+    def _lora_B_block(self) -> torch.Tensor:
+        """Arrange LoRA's B matrix as a block diagonal matrix over all output features.
+
+        For enable_lora [True, False, True] the result looks like:
+
+        [[B_q, 0  ],   <- query rows
+         [0,   0  ],   <- key rows
+         [0,   B_v]]   <- value rows
+
+        It's rebuilt from `self.lora_B` on every call with a single index_copy: it's small
+        (out_features x r * sum(enable_lora)), always in sync with the optimizer updates and gradients flow back to
+        `self.lora_B`.
+
+        Returns:
+            A tensor of shape (out_features, r * sum(enable_lora))
+        """
+        n_groups = sum(self.enable_lora)
+        B_block = self.lora_B.new_zeros((self.out_features * n_groups, self.r))  # (768, 2)
+        B_block = B_block.index_copy(0, self.lora_B_index, self.lora_B)  # (256, 2) scattered into (768, 2)
+        return B_block.view(self.out_features, n_groups * self.r)  # (384, 4)
+
     def train(self, mode: bool = True):
         """Set the module into train or eval mode if `mode` is True of False respectively.
 
@@ -262,11 +291,13 @@ class MergedLinear(nn.Linear, LoRALayer):
         # ⚬ self.lora_B.data: (256, 2)
         if self.merge_weights and should:
             if self.r > 0 and any(self.enable_lora):
-                delta_w = F.conv1d(
-                    self.lora_A.data.unsqueeze(0),   # (4, 128) -> (1, 4, 128)
-                    self.lora_B.data.unsqueeze(-1),  # (256, 2) -> (256, 2, 1)
-                    groups=sum(self.enable_lora)
-                ).squeeze(0) # (1, 4, 128) @ (256, 2, 1) -> (1, 256, 128) -> (256, 128)
+                # every enabled matrix has its own block of A and B, so the update is a batch of small matmuls
+                # (a grouped F.conv1d computes the same, but goes through the generic convolution kernels)
+                n_groups = sum(self.enable_lora)
+                delta_w = torch.bmm(
+                    self.lora_B.data.view(n_groups, -1, self.r),  # (256, 2) -> (2, 128, 2)
+                    self.lora_A.data.view(n_groups, self.r, -1),  # (4, 128) -> (2, 2, 128)
+                ).view(-1, self.lora_A.shape[-1])  # (2, 128, 2) @ (2, 2, 128) -> (2, 128, 128) -> (256, 128)
                 # -1: W = W - delta_W (unmerge), +1: W = W + delta_W (merge)
                 sign = -1 if mode else 1
                 self.weight.data += sign * self.zero_pad(T(delta_w * self.scaling)) # (256, 128) after zero_pad (384, 128)
@@ -305,17 +336,13 @@ class MergedLinear(nn.Linear, LoRALayer):
             result = F.linear(x, T(self.weight), bias=self.bias)  # (64, 64, 128) @ (384, 128) -> (64, 64, 384)
             if self.r > 0:
                 after_A = F.linear(self.lora_dropout(x), self.lora_A)  # (64, 64, 128) @ (4, 128) -> (64, 64, 4)
-                # For F.conv1d:
-                # ⚬ input: input tensor of shape (mini-batch, in_channels, iW)
-                # ⚬ weight: filters of shape (out_channels, in_channels/groups, kW)
-                # ⚬ groups: split input into groups, in_channels should be divisible by the number of groups. Default: 1
-                # presumably iW - sequence width/length, kW - kernel width
-                after_B = F.conv1d(
-                    after_A.transpose(-2, -1),  # (64, 64, 4) -> (64, 4, 64)
-                    self.lora_B.unsqueeze(-1),  # (256, 2) -> (256, 2, 1)
-                    groups=sum(self.enable_lora)
-                ).transpose(-2, -1)  # (64, 4, 64) @ (256, 2, 1) -> (64, 256, 64) -> (64, 64, 256)
-                result += self.zero_pad(after_B) * self.scaling  # (64, 64, 256) after zero_pad (64, 64, 384)
+                # B_block holds the blocks of lora_B on its diagonal and zeros for the key rows, so one GEMM gives
+                # the update for all output features directly (no zero padding of the result afterwards). It's
+                # accumulated into the result in place with the scaling, so no (64, 64, 384) temporary is created
+                B_block = self._lora_B_block()  # (384, 4)
+                result.view(-1, self.out_features).addmm_(
+                    after_A.reshape(-1, after_A.shape[-1]), B_block.t(), alpha=self.scaling
+                )  # (4096, 4) @ (4, 384) -> (4096, 384)
             return result
 
 
@@ -45,13 +45,221 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import functools
 import math
-from typing import Dict, List
+from typing import Dict, List, NamedTuple, Optional
 
 import lit_llama.model as llama
 
 from contextlib import contextmanager
-from dataclasses import dataclass
+
+try:
+    import triton  # noqa: E402
+    import triton.language as tl  # noqa: E402
+except:
+    triton = None
+
+
+if triton is not None:
+    # Base GEMM `x @ W.T` with the LoRA up-projection fused into the epilogue, so the
+    # (M, N) LoRA output is never written to memory on its own. Adapted from the OpenAI
+    # Triton matmul example, same as `linear_kernel_4bit_weight` in quantization.py.
+    @triton.autotune(
+        configs=[
+            triton.Config(
+                {
+                    "BLOCK_SIZE_M": 128,
+                    "BLOCK_SIZE_N": 256,
+                    "BLOCK_SIZE_K": 32,
+                    "GROUP_SIZE_M": 8,
+                },
+                num_stages=3,
+                num_warps=8,
+            ),
+            triton.Config(
+                {
+                    "BLOCK_SIZE_M": 128,
+                    "BLOCK_SIZE_N": 128,
+                    "BLOCK_SIZE_K": 32,
+                    "GROUP_SIZE_M": 8,
+                },
+                num_stages=4,
+                num_warps=4,
+            ),
+            triton.Config(
+                {
+                    "BLOCK_SIZE_M": 64,
+                    "BLOCK_SIZE_N": 128,
+                    "BLOCK_SIZE_K": 32,
+                    "GROUP_SIZE_M": 8,
+                },
+                num_stages=4,
+                num_warps=4,
+            ),
+            triton.Config(
+                {
+                    "BLOCK_SIZE_M": 32,
+                    "BLOCK_SIZE_N": 64,
+                    "BLOCK_SIZE_K": 32,
+                    "GROUP_SIZE_M": 8,
+                },
+                num_stages=5,
+                num_warps=2,
+            ),
+        ],
+        key=["M", "N", "K"],
+    )
+    @triton.jit
+    def lora_linear_kernel(
+        # Pointers to matrices
+        x_ptr,
+        w_ptr,
+        xa_ptr,
+        b_ptr,
+        c_ptr,
+        # Matrix dimensions
+        M,
+        N,
+        K,
+        R,
+        scaling,
+        # Strides
+        stride_xm,
+        stride_xk,
+        stride_wn,
+        stride_wk,
+        stride_xam,
+        stride_xar,
+        stride_bn,
+        stride_br,
+        stride_cm,
+        stride_cn,
+        # Meta-parameters
+        BLOCK_SIZE_M: tl.constexpr,
+        BLOCK_SIZE_N: tl.constexpr,
+        BLOCK_SIZE_K: tl.constexpr,
+        BLOCK_SIZE_R: tl.constexpr,
+        GROUP_SIZE_M: tl.constexpr,
+    ):
+        """Kernel for computing C = X @ W.T + scaling * XA @ B.T.
+        X has shape (M, K), W has shape (N, K), XA = X @ A.T has shape (M, R), B has shape (N, R)
+        and C has shape (M, N). All operands are read through their strides, so transposed views
+        (e.g. the weight of a `fan_in_fan_out` layer) are consumed as is, without a contiguous copy.
+        """
+        # grouped ordering of the output blocks to promote L2 data reuse
+        pid = tl.program_id(axis=0)
+        num_pid_m = tl.cdiv(M, BLOCK_SIZE_M)
+        num_pid_n = tl.cdiv(N, BLOCK_SIZE_N)
+        num_pid_in_group = GROUP_SIZE_M * num_pid_n
+        group_id = pid // num_pid_in_group
+        first_pid_m = group_id * GROUP_SIZE_M
+        group_size_m = min(num_pid_m - first_pid_m, GROUP_SIZE_M)
+        pid_m = first_pid_m + (pid % group_size_m)
+        pid_n = (pid % num_pid_in_group) // group_size_m
+
+        offs_m = pid_m * BLOCK_SIZE_M + tl.arange(0, BLOCK_SIZE_M)
+        offs_n = pid_n * BLOCK_SIZE_N + tl.arange(0, BLOCK_SIZE_N)
+        offs_k = tl.arange(0, BLOCK_SIZE_K)
+        m_mask = offs_m[:, None] < M
+        n_mask = offs_n[None, :] < N
+        # x_ptrs is a block of [BLOCK_SIZE_M, BLOCK_SIZE_K] pointers,
+        # w_ptrs is a block of [BLOCK_SIZE_K, BLOCK_SIZE_N] pointers (a tile of W.T)
+        x_ptrs = x_ptr + (offs_m[:, None] * stride_xm + offs_k[None, :] * stride_xk)
+        w_ptrs = w_ptr + (offs_k[:, None] * stride_wk + offs_n[None, :] * stride_wn)
+
+        # base GEMM, accumulated in fp32
+        accumulator = tl.zeros((BLOCK_SIZE_M, BLOCK_SIZE_N), dtype=tl.float32)
+        for k in range(0, K, BLOCK_SIZE_K):
+            k_mask = offs_k < K - k
+            x = tl.load(x_ptrs, mask=m_mask & k_mask[None, :], other=0.0)
+            w = tl.load(w_ptrs, mask=k_mask[:, None] & n_mask, other=0.0)
+            accumulator += tl.dot(x, w)
+            x_ptrs += BLOCK_SIZE_K * stride_xk
+            w_ptrs += BLOCK_SIZE_K * stride_wk
+
+        # epilogue: add the LoRA branch for this output tile while it is still in registers
+        offs_r = tl.arange(0, BLOCK_SIZE_R)
+        r_mask = offs_r < R
+        xa_ptrs = xa_ptr + (offs_m[:, None] * stride_xam + offs_r[None, :] * stride_xar)
+        b_ptrs = b_ptr + (offs_r[:, None] * stride_br + offs_n[None, :] * stride_bn)
+        xa = tl.load(xa_ptrs, mask=m_mask & r_mask[None, :], other=0.0)
+        b = tl.load(b_ptrs, mask=r_mask[:, None] & n_mask, other=0.0)
+        accumulator += tl.dot(xa, b) * scaling
+
+        c = accumulator.to(c_ptr.dtype.element_ty)
+        c_ptrs = c_ptr + stride_cm * offs_m[:, None] + stride_cn * offs_n[None, :]
+        tl.store(c_ptrs, c, mask=m_mask & n_mask)
+
+    class LoRALinearFunction(torch.autograd.Function):
+        """`x @ weight.T + scaling * after_A @ lora_B.T` with the forward done by `lora_linear_kernel`.
+
+        `after_A` (= `x @ lora_A.T`) is computed outside so that dropout and the gradient of `lora_A`
+        are handled by autograd as usual.
+        """
+
+        @staticmethod
+        def forward(ctx, x, weight, after_A, lora_B, scaling):
+            ctx.save_for_backward(x, weight, after_A, lora_B)
+            ctx.scaling = scaling
+            x2 = x.reshape(-1, x.shape[-1])  # (M, K)
+            xa2 = after_A.reshape(-1, after_A.shape[-1])  # (M, R)
+            M, K = x2.shape
+            N, R = lora_B.shape
+            c = torch.empty((M, N), device=x.device, dtype=x.dtype)
+            grid = lambda META: (
+                triton.cdiv(M, META["BLOCK_SIZE_M"]) * triton.cdiv(N, META["BLOCK_SIZE_N"]),
+            )
+            lora_linear_kernel[grid](
+                x2,
+                weight,
+                xa2,
+                lora_B,
+                c,
+                M,
+                N,
+                K,
+                R,
+                scaling,
+                x2.stride(0),
+                x2.stride(1),
+                weight.stride(0),
+                weight.stride(1),
+                xa2.stride(0),
+                xa2.stride(1),
+                lora_B.stride(0),
+                lora_B.stride(1),
+                c.stride(0),
+                c.stride(1),
+                # tl.dot needs every dimension to be at least 16
+                BLOCK_SIZE_R=max(16, triton.next_power_of_2(R)),
+            )
+            return c.view(*x.shape[:-1], N)
+
+        @staticmethod
+        def backward(ctx, grad_output):
+            x, weight, after_A, lora_B = ctx.saved_tensors
+            grad = grad_output.reshape(-1, grad_output.shape[-1])  # (M, N)
+            # the LoRA matrices may be kept in a different dtype than the pretrained weights
+            lora_grad = grad.to(lora_B.dtype)
+            grad_x = grad_weight = grad_after_A = grad_B = None
+            if ctx.needs_input_grad[0]:
+                grad_x = (grad @ weight).view(x.shape)
+            if ctx.needs_input_grad[1]:
+                grad_weight = grad.t() @ x.reshape(-1, x.shape[-1])
+            if ctx.needs_input_grad[2]:
+                grad_after_A = (lora_grad @ lora_B * ctx.scaling).view(after_A.shape)
+            if ctx.needs_input_grad[3]:
+                grad_B = lora_grad.t() @ after_A.reshape(-1, after_A.shape[-1]) * ctx.scaling
+            return grad_x, grad_weight, grad_after_A, grad_B, None
+
+    def lora_linear(x, weight, after_A, lora_B, scaling, bias=None):
+        result = LoRALinearFunction.apply(x, weight, after_A, lora_B, scaling)
+        if bias is not None:
+            result = result + bias
+        return result
+
+else:
+    lora_linear = None
 
 
 class LoRALayerFull():
@@ -86,10 +294,20 @@ class MergedLinearFull(nn.Linear, LoRALayerFull):
         enable_lora: List[bool] = [False],
         fan_in_fan_out: bool = False,
         merge_weights: bool = True,
+        lora_dtype: Optional[torch.dtype] = None,
         **kwargs
     ):
 
-        nn.Linear.__init__(self, in_features, out_features, **kwargs)
+        if fan_in_fan_out:
+            # create the weight directly in the (in_features, out_features) layout instead of transposing
+            # an (out_features, in_features) one after the fact: nn.Linear only allocates on "meta" here
+            nn.Linear.__init__(self, in_features, out_features, **{**kwargs, 'device': 'meta'})
+            weight_kwargs = {'device': kwargs.get('device'), 'dtype': kwargs.get('dtype')}
+            self.weight = nn.Parameter(torch.empty((in_features, out_features), **weight_kwargs))
+            if self.bias is not None:
+                self.bias = nn.Parameter(torch.empty(out_features, **weight_kwargs))
+        else:
+            nn.Linear.__init__(self, in_features, out_features, **kwargs)
         LoRALayerFull.__init__(self, r=r, lora_alpha=lora_alpha, lora_dropout=lora_dropout,
                            merge_weights=merge_weights)
         assert out_features % len(enable_lora) == 0, \
@@ -98,57 +316,112 @@ class MergedLinearFull(nn.Linear, LoRALayerFull):
         self.fan_in_fan_out = fan_in_fan_out
 
         if r > 0 and any(enable_lora):
-            self.lora_A = nn.Parameter(
-                self.weight.new_zeros(r, in_features))  # (4, 128)
-            self.lora_B = nn.Parameter(
-                self.weight.new_zeros((out_features , r))  # (256, 2)
-            )
+            # same factory arguments as nn.Linear, so LoRA's matrices are created directly on the target
+            # device (including "meta") instead of being allocated elsewhere and moved afterwards
+            factory_kwargs = {'device': kwargs.get('device'), 'dtype': lora_dtype or kwargs.get('dtype')}
+            # A is overwritten by the initialization below, so it is not zero-filled first
+            self.lora_A = nn.Parameter(torch.empty((r, in_features), **factory_kwargs))  # (4, 128)
+            self.lora_B = nn.Parameter(torch.zeros((out_features, r), **factory_kwargs))  # (256, 2)
             self.scaling = self.lora_alpha / self.r
             self.weight.requires_grad = False 
-        self.reset_parameters()
         if fan_in_fan_out:
-            self.weight.data = self.weight.data.T
+            # the weight was created uninitialized above
+            self.reset_parameters()
+        else:
+            # the pretrained weights were already initialized by nn.Linear.__init__
+            self.reset_lora_parameters()
+        self._bind_forward()
 
     def reset_parameters(self):
-        nn.Linear.reset_parameters(self)
+        # `fan_in_fan_out` isn't set yet when nn.Linear.__init__ calls this method
+        if getattr(self, 'fan_in_fan_out', False):
+            # same as nn.Linear.reset_parameters, but through the (out_features, in_features) view
+            # so that the fan-in is taken from the right dimension
+            nn.init.kaiming_uniform_(self.weight.T, a=math.sqrt(5))
+            if self.bias is not None:
+                bound = 1 / math.sqrt(self.in_features) if self.in_features > 0 else 0
+                nn.init.uniform_(self.bias, -bound, bound)
+        else:
+            nn.Linear.reset_parameters(self)
+        self.reset_lora_parameters()
+
+    def reset_lora_parameters(self):
         if hasattr(self, 'lora_A'):
             nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
             nn.init.zeros_(self.lora_B)
 
+    def _bind_forward(self) -> None:
+        # choose the forward pass once here (and on merge/unmerge) instead of branching on every call, including the
+        # weight layout: the common (out_features, in_features) case passes `self.weight` to F.linear as is
+        if self.merged or not hasattr(self, 'lora_A'):
+            forwards = (self._forward_merged, self._forward_merged_fan_in_fan_out)
+        elif isinstance(self.lora_dropout, nn.Dropout):
+            forwards = (self._forward_lora_dropout, self._forward_lora_dropout_fan_in_fan_out)
+        else:
+            forwards = (self._forward_lora, self._forward_lora_fan_in_fan_out)
+        self.forward = forwards[1] if self.fan_in_fan_out else forwards[0]
+
+    @torch.no_grad()
+    def _merge(self, sign: int) -> None:
+        """Add (sign=1) or subtract (sign=-1) the scaled weight update `lora_B @ lora_A` in place.
+
+        The update is accumulated straight into the pretrained weights by `addmm_`, so no
+        (out_features, in_features) delta is allocated.
+        """
+        weight = self.weight.data.T if self.fan_in_fan_out else self.weight.data  # (out_features, in_features)
+        weight.addmm_(self.lora_B.to(weight.dtype), self.lora_A.to(weight.dtype), alpha=sign * self.scaling)
+
     def train(self, mode: bool = True):
-        
-        def T(w):
-            return w.T if self.fan_in_fan_out else w
-        
         nn.Linear.train(self, mode)
-        should = self.merged if mode else not self.merged
-        if self.merge_weights and should:
-            if self.r > 0 and any(self.enable_lora):
-                delta_w = F.conv1d(
-                    self.lora_A.data.unsqueeze(0),   
-                    self.lora_B.data.unsqueeze(-1), 
-                ).squeeze(0) 
-                sign = -1 if mode else 1
-                self.weight.data += sign * delta_w * self.scaling 
+        # train(True) -> unmerge if merged, train(False) -> merge if not merged
+        if self.merge_weights and mode == self.merged:
+            if hasattr(self, 'lora_A'):
+                self._merge(-1 if mode else 1)
             self.merged = not mode
-
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-       
-        def T(w):
-            return w.T if self.fan_in_fan_out else w
-
-        if self.merged:
-            return F.linear(x, T(self.weight), bias=self.bias)
-        else:
-            result = F.linear(x, T(self.weight), bias=self.bias)  
-            if self.r > 0:
-                after_A = F.linear(self.lora_dropout(x), self.lora_A)  
-                after_B = F.conv1d(
-                    after_A.transpose(-2, -1),  
-                    self.lora_B.unsqueeze(-1),  
-                ).transpose(-2, -1)  
-                result += after_B * self.scaling  
-            return result
+            self._bind_forward()
+
+    def _forward_merged(self, x: torch.Tensor) -> torch.Tensor:
+        return F.linear(x, self.weight, bias=self.bias)
+
+    def _forward_merged_fan_in_fan_out(self, x: torch.Tensor) -> torch.Tensor:
+        return F.linear(x, self.weight.T, bias=self.bias)
+
+    def _forward_lora(self, x: torch.Tensor) -> torch.Tensor:
+        return self._forward_with_lora(x, x, self.weight)
+
+    def _forward_lora_fan_in_fan_out(self, x: torch.Tensor) -> torch.Tensor:
+        return self._forward_with_lora(x, x, self.weight.T)
+
+    def _forward_lora_dropout(self, x: torch.Tensor) -> torch.Tensor:
+        return self._forward_with_lora(x, self.lora_dropout(x), self.weight)
+
+    def _forward_lora_dropout_fan_in_fan_out(self, x: torch.Tensor) -> torch.Tensor:
+        return self._forward_with_lora(x, self.lora_dropout(x), self.weight.T)
+
+    def _forward_with_lora(self, x: torch.Tensor, lora_x: torch.Tensor, weight: torch.Tensor) -> torch.Tensor:
+        # `weight` is in the (out_features, in_features) layout that F.linear expects (picked by `_bind_forward`).
+        # The LoRA branch runs in the dtype of the LoRA matrices, the base GEMM in the weight dtype
+        after_A = F.linear(lora_x.to(self.lora_A.dtype), self.lora_A)  # (..., r)
+        # `tl.dot` needs both operands of each product in the same dtype, and `LoRALinearFunction` does not do
+        # the casting that autocast applies to F.linear, so anything else goes through the unfused path
+        if (
+            lora_linear is not None
+            and x.is_cuda
+            and not torch.is_autocast_enabled()
+            and x.dtype in (torch.float16, torch.bfloat16)
+            and weight.dtype == x.dtype
+            and self.lora_A.dtype in (torch.float16, torch.bfloat16)
+        ):
+            return lora_linear(x, weight, after_A, self.lora_B, self.scaling, self.bias)
+        result = F.linear(x, weight, bias=self.bias)
+        # result += scaling * after_A @ lora_B.T as a single in-place addmm: no (..., out_features)
+        # temporaries for the LoRA output and its scaled copy. The casts only touch the small rank-r tensors
+        result.view(-1, result.shape[-1]).addmm_(
+            after_A.reshape(-1, after_A.shape[-1]).to(result.dtype),
+            self.lora_B.to(result.dtype).t(),
+            alpha=self.scaling,
+        )
+        return result
 
 
 def mark_only_lora_as_trainable(model: nn.Module, bias: str = 'none') -> None:
@@ -164,26 +437,44 @@ def mark_only_lora_as_trainable(model: nn.Module, bias: str = 'none') -> None:
     Raises:
         NotImplementedError: if `bias` not in ["none", "lora_only", "all"]
     """
-    # freeze all layers except LoRA's
-    for n, p in model.named_parameters():
-        if 'lora_' not in n:
-            p.requires_grad = False
+    if bias not in ('none', 'lora_only', 'all'):
+        raise NotImplementedError
 
-    # depending on the `bias` value unfreeze bias weights
-    if bias == 'none':
-        return
-    elif bias == 'all':
-        for n, p in model.named_parameters():
-            if 'bias' in n:
+    # a single pass over the direct parameters of every module: the owner of each bias is known
+    # without a second walk over the model
+    for m in model.modules():
+        is_lora = isinstance(m, LoRALayerFull)
+        for n, p in m.named_parameters(recurse=False):
+            if n in ('lora_A', 'lora_B'):
                 p.requires_grad = True
-    elif bias == 'lora_only':
-        for m in model.modules():
-            if isinstance(m, LoRALayerFull) and \
-                hasattr(m, 'bias') and \
-                m.bias is not None:
-                    m.bias.requires_grad = True
-    else:
-        raise NotImplementedError
+            elif n == 'bias':
+                p.requires_grad = bias == 'all' or (bias == 'lora_only' and is_lora)
+            else:
+                p.requires_grad = False
+
+
+def make_lora_optimizer(model: nn.Module, cls=torch.optim.AdamW, **kwargs) -> torch.optim.Optimizer:
+    """Create an optimizer over the trainable parameters that steps all of them with a handful of kernels.
+
+    With LoRA only the small A and B matrices of every layer are trained, so a per-parameter optimizer step is
+    dominated by kernel launches. Unless ``fused``/``foreach`` is passed explicitly, ``fused=True`` is used when all
+    parameters are on CUDA and ``foreach=True`` otherwise.
+
+    Args:
+        model: model with LoRA layers, usually after `mark_only_lora_as_trainable`
+        cls: optimizer class that supports the ``fused`` and ``foreach`` arguments
+        kwargs: arguments of the optimizer (learning rate, weight decay, ...)
+
+    Returns:
+        Optimizer for the parameters that require gradients
+    """
+    params = [p for p in model.parameters() if p.requires_grad]
+    if 'fused' not in kwargs and 'foreach' not in kwargs:
+        if all(p.is_cuda for p in params):
+            kwargs['fused'] = True
+        else:
+            kwargs['foreach'] = True
+    return cls(params, **kwargs)
 
 
 def lora_state_dict(model: nn.Module, bias: str = 'none') -> Dict[str, torch.Tensor]:
@@ -201,36 +492,49 @@ def lora_state_dict(model: nn.Module, bias: str = 'none') -> Dict[str, torch.Ten
 
     Raises:
         NotImplementedError: if `bias` not in ["none", "lora_only", "all"]
+        RuntimeError: if the state dict of the model misses some of the LoRA entries
     """
-    my_state_dict = model.state_dict()
-    if bias == 'none':
-        return {k: my_state_dict[k] for k in my_state_dict if 'lora_' in k}
-    elif bias == 'all':
-        return {k: my_state_dict[k] for k in my_state_dict if 'lora_' in k or 'bias' in k}
-    elif bias == 'lora_only':
-        to_return = {}
-        for k in my_state_dict:
-            if 'lora_' in k:
-                to_return[k] = my_state_dict[k]
-                bias_name = k.split('lora_')[0]+'bias'
-                if bias_name in my_state_dict:
-                    to_return[bias_name] = my_state_dict[bias_name]
-        return to_return
-    else:
+    if bias not in ('none', 'lora_only', 'all'):
         raise NotImplementedError
 
-
-@dataclass
-class LoRAConfig:
+    # `model.state_dict()` only holds references to the tensors, and it runs every `state_dict` override and hook
+    # (Fabric's wrapper, FSDP's full state dict), so its keys are the ones `load_state_dict` expects. The LoRA
+    # entries are picked by their exact parameter names instead of a substring match on the whole key
+    my_state_dict = model.state_dict()
+    lora_layers = [m for m in model.modules() if isinstance(m, LoRALayerFull) and hasattr(m, 'lora_A')]
+    to_return = {}
+    n_lora_biases = 0
+    for k in my_state_dict:
+        module_prefix, _, name = k.rpartition('.')
+        if name in ('lora_A', 'lora_B'):
+            to_return[k] = my_state_dict[k]
+            bias_name = module_prefix + '.bias' if module_prefix else 'bias'
+            if bias == 'lora_only' and name == 'lora_A' and bias_name in my_state_dict:
+                to_return[bias_name] = my_state_dict[bias_name]
+                n_lora_biases += 1
+        elif name == 'bias' and bias == 'all':
+            to_return[k] = my_state_dict[k]
+
+    n_lora = sum(k.rpartition('.')[2] in ('lora_A', 'lora_B') for k in to_return)
+    if n_lora != 2 * len(lora_layers):
+        raise RuntimeError(
+            f"Expected the A and B matrices of {len(lora_layers)} LoRA layers in the state dict, found {n_lora} entries"
+        )
+    if bias == 'lora_only' and n_lora_biases != sum(m.bias is not None for m in lora_layers):
+        raise RuntimeError("The state dict is missing the bias of some LoRA layers")
+    return to_return
+
+
+class LoRAConfig(NamedTuple):
     r: float = 0.0
     alpha: float = 1.0
     dropout: float = 0.0
+    compile: bool = False
+    dtype: Optional[torch.dtype] = None
 
 
 class CausalSelfAttention(llama.CausalSelfAttention):
-    lora_config = None
-
-    def __init__(self, config: llama.LLaMAConfig) -> None:
+    def __init__(self, config: llama.LLaMAConfig, lora_config: LoRAConfig) -> None:
         """Causal self-attention with calculating qkv matrices with a single matrix* and Low Ranking Adaptation for
         parameter-efficient fine-tuning.
 
@@ -245,22 +549,26 @@ class CausalSelfAttention(llama.CausalSelfAttention):
                 ``"n_layer"``: number of transformer blocks (self-attention + MLP),
                 ``"n_head"``: number of heads in multi-head attention mechanism,
                 ``"n_embd"``: size of the embedding: vector representation of each token.
+            lora_config: rank, alpha, dropout etc. of the LoRA update of the qkv projection
         """
         # Skip the parent class __init__ altogether and replace it to avoid
         # useless allocations
         nn.Module.__init__(self)
         assert config.n_embd % config.n_head == 0
+        self.lora_config = lora_config
 
         # key, query, value projections for all heads, but in a batch
+        # LoRA's B matrix spans all of query, key and value
         self.c_attn = MergedLinearFull(
             in_features=config.n_embd,
             out_features=3 * config.n_embd,
             r=self.lora_config.r,
             lora_alpha=self.lora_config.alpha,
             lora_dropout=self.lora_config.dropout,
-            enable_lora=[True, False, True],
-            fan_in_fan_out = False,
+            enable_lora=[True, True, True],
+            fan_in_fan_out=False,
             merge_weights=True,
+            lora_dtype=self.lora_config.dtype,
             bias=False)
         # output projection
         self.c_proj = nn.Linear(config.n_embd, config.n_embd, bias=False)
@@ -268,11 +576,31 @@ class CausalSelfAttention(llama.CausalSelfAttention):
         self.n_head = config.n_head
         self.n_embd = config.n_embd
         self.block_size = config.block_size
-        self.rope_cache = None
+        # compile every block on its own instead of the whole model: blocks are identical, so the
+        # graph is traced once and the rest of the model is left in eager mode. `nn.Module.compile`
+        # compiles in place, so parameter names, deepcopy and pickling behave as without it. `train`
+        # takes care of it, so that only the training forward is compiled
+        self.train(self.training)
+
+    def train(self, mode: bool = True):
+        """Set the module into train or eval mode, and compile it for training only (if `lora_config.compile`).
+
+        In eval mode the weights of `c_attn` are merged and generation feeds prompts of varying length followed by
+        single tokens, which with `dynamic=False` would recompile on every new shape (and on every merge, which
+        rebinds `c_attn.forward`), so eval stays in eager mode. Note that the debug `print` calls in
+        `llama.CausalSelfAttention.forward` break the compiled block into several graphs.
+        """
+        nn.Module.train(self, mode)
+        if self.lora_config.compile and self.lora_config.r > 0:
+            if mode:
+                self.compile(dynamic=False)
+            else:
+                self._compiled_call_impl = None
+        return self
 
 
 @contextmanager
-def lora(r, alpha, dropout, enabled: bool = True):
+def lora(r, alpha, dropout, enabled: bool = True, compile: bool = False, dtype: Optional[torch.dtype] = None):
     """Apply context manager under which you can instantiate the model with LoRA.
 
     In a nutshell the code inside this function forces to use LoRA variant of causal self-attention
@@ -286,18 +614,20 @@ def lora(r, alpha, dropout, enabled: bool = True):
             https://arxiv.org/pdf/2106.09685.pdf (section 4.1)
         dropout: dropout that is applied on the input in the LoRA branch (before multiplying by matrix A)
         enabled: enables/disables LoRA
+        compile: compiles each causal self-attention block with `torch.compile` while it is in train mode
+        dtype: dtype of LoRA's A and B matrices (e.g. `torch.bfloat16` to halve the memory traffic of the LoRA
+            branch). By default the dtype of the pretrained weights is used
     """
     if not enabled:
         yield
         return
 
-    CausalSelfAttention.lora_config = LoRAConfig(r=r, alpha=alpha, dropout=dropout)
+    lora_config = LoRAConfig(r=r, alpha=alpha, dropout=dropout, compile=compile, dtype=dtype)
     # when entering context manager replace link to causal self-attention class from original
-    # to a variant with LoRA
+    # to the variant with LoRA. `Block` only passes the model config, so the LoRA config is bound with a partial:
+    # the instances are still of the module-level class (picklable) and carry their config as a plain value
     causal_self_attention = llama.CausalSelfAttention
-    llama.CausalSelfAttention = CausalSelfAttention
+    llama.CausalSelfAttention = functools.partial(CausalSelfAttention, lora_config=lora_config)
     yield
     # when exiting context manager - restore link to original causal self-attention class
     llama.CausalSelfAttention = causal_self_attention
-
-    CausalSelfAttention.lora_config = None
@@ -0,0 +1,72 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("lightning")
+pytest.importorskip("sentencepiece")
+
+# make `lit_llama` importable when the tests are run from the repository root
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import torch.nn.functional as F  # noqa: E402
+
+from lit_llama import lora  # noqa: E402
+
+
+def _make_layer(enable_lora):
+    torch.manual_seed(0)
+    layer = lora.MergedLinear(16, 48, r=2, lora_alpha=4, enable_lora=enable_lora, bias=False)
+    # `reset_parameters` doesn't initialize anything and B starts as zeros, so fill all the matrices explicitly
+    with torch.no_grad():
+        for p in (layer.weight, layer.lora_A, layer.lora_B):
+            p.normal_()
+    return layer
+
+
+def _conv1d_delta_w(layer):
+    # the weight update as computed by the original grouped F.conv1d implementation
+    return F.conv1d(
+        layer.lora_A.unsqueeze(0), layer.lora_B.unsqueeze(-1), groups=sum(layer.enable_lora)
+    ).squeeze(0)
+
+
+def _conv1d_forward(layer, x):
+    after_A = F.linear(x, layer.lora_A)
+    after_B = F.conv1d(
+        after_A.transpose(-2, -1), layer.lora_B.unsqueeze(-1), groups=sum(layer.enable_lora)
+    ).transpose(-2, -1)
+    return F.linear(x, layer.weight) + layer.zero_pad(after_B) * layer.scaling
+
+
+@pytest.mark.parametrize("enable_lora", [[True, False, True], [True, True, True], [False, True, False]])
+def test_forward_matches_grouped_conv1d(enable_lora):
+    layer = _make_layer(enable_lora)
+    x = torch.randn(2, 5, 16)
+
+    actual = layer(x)
+    expected = _conv1d_forward(layer, x)
+    torch.testing.assert_close(actual, expected)
+
+    grad = torch.randn_like(actual)
+    (lora_A_grad, lora_B_grad) = torch.autograd.grad(actual, (layer.lora_A, layer.lora_B), grad)
+    (expected_A_grad, expected_B_grad) = torch.autograd.grad(expected, (layer.lora_A, layer.lora_B), grad)
+    torch.testing.assert_close(lora_A_grad, expected_A_grad)
+    torch.testing.assert_close(lora_B_grad, expected_B_grad)
+
+
+@pytest.mark.parametrize("enable_lora", [[True, False, True], [True, True, True]])
+def test_merge_unmerge_matches_grouped_conv1d(enable_lora):
+    layer = _make_layer(enable_lora)
+    weight = layer.weight.detach().clone()
+    with torch.no_grad():
+        expected = weight + layer.zero_pad(_conv1d_delta_w(layer) * layer.scaling)
+
+    layer.eval()
+    assert layer.merged
+    torch.testing.assert_close(layer.weight.detach(), expected)
+
+    layer.train()
+    assert not layer.merged
+    torch.testing.assert_close(layer.weight.detach(), weight)
@@ -0,0 +1,142 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("lightning")
+pytest.importorskip("sentencepiece")
+
+# make `lit_llama` importable when the tests are run from the repository root
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import torch.nn.functional as F  # noqa: E402
+
+from lit_llama import lora_new  # noqa: E402
+
+
+@pytest.mark.skipif(
+    not torch.cuda.is_available() or lora_new.lora_linear is None, reason="the fused kernel needs CUDA and triton"
+)
+@pytest.mark.parametrize("dtype, tol", [(torch.float16, 1e-2), (torch.bfloat16, 5e-2)])
+def test_fused_lora_linear_matches_eager(dtype, tol, monkeypatch):
+    # the eager path would pass the comparison as well, so check that the kernel was actually used
+    calls = []
+    lora_linear = lora_new.lora_linear
+
+    def spy(*args, **kwargs):
+        calls.append(args)
+        return lora_linear(*args, **kwargs)
+
+    monkeypatch.setattr(lora_new, "lora_linear", spy)
+
+    torch.manual_seed(0)
+    layer = lora_new.MergedLinearFull(
+        128, 384, r=8, lora_alpha=16, enable_lora=[True, True, True], bias=False, device="cuda", dtype=dtype
+    )
+    # B starts as zeros, which would hide any error in the LoRA part of the kernel
+    torch.nn.init.normal_(layer.lora_B, std=0.1)
+    x = torch.randn(2, 37, 128, device="cuda", dtype=dtype, requires_grad=True)
+
+    # eager reference in fp32
+    x_ref = x.detach().float().requires_grad_()
+    weight = layer.weight.detach().float()
+    lora_A = layer.lora_A.detach().float().requires_grad_()
+    lora_B = layer.lora_B.detach().float().requires_grad_()
+    expected = F.linear(x_ref, weight) + layer.scaling * F.linear(F.linear(x_ref, lora_A), lora_B)
+
+    actual = layer(x)
+    assert len(calls) == 1
+    torch.testing.assert_close(actual.float(), expected, atol=tol, rtol=tol)
+
+    grad = torch.randn_like(expected)
+    actual.backward(grad.to(dtype))
+    expected.backward(grad)
+    torch.testing.assert_close(x.grad.float(), x_ref.grad, atol=tol, rtol=tol)
+    torch.testing.assert_close(layer.lora_A.grad.float(), lora_A.grad, atol=tol, rtol=tol)
+    torch.testing.assert_close(layer.lora_B.grad.float(), lora_B.grad, atol=tol, rtol=tol)
+
+
+class _LoRAModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.qkv = lora_new.MergedLinearFull(8, 24, r=2, enable_lora=[True, True, True], bias=False)
+        self.proj = lora_new.MergedLinearFull(8, 8, r=2, enable_lora=[True])
+        self.head = torch.nn.Linear(8, 4)
+
+
+class _StateDictWrapper(torch.nn.Module):
+    # like Fabric's `_FabricModule`: registered as a submodule, but `state_dict` returns the keys of the wrapped module
+    def __init__(self, module):
+        super().__init__()
+        self._forward_module = module
+
+    def state_dict(self, *args, **kwargs):
+        return self._forward_module.state_dict(*args, **kwargs)
+
+
+@pytest.mark.parametrize("wrap", [False, True])
+@pytest.mark.parametrize(
+    "bias, expected",
+    [
+        ("none", {"qkv.lora_A", "qkv.lora_B", "proj.lora_A", "proj.lora_B"}),
+        ("lora_only", {"qkv.lora_A", "qkv.lora_B", "proj.lora_A", "proj.lora_B", "proj.bias"}),
+        ("all", {"qkv.lora_A", "qkv.lora_B", "proj.lora_A", "proj.lora_B", "proj.bias", "head.bias"}),
+    ],
+)
+def test_lora_state_dict_keys(bias, expected, wrap):
+    model = _LoRAModel()
+    state_dict = lora_new.lora_state_dict(_StateDictWrapper(model) if wrap else model, bias=bias)
+    assert set(state_dict) == expected
+
+    # the keys load back into a freshly created model
+    missing, unexpected = _LoRAModel().load_state_dict(state_dict, strict=False)
+    assert not unexpected
+    assert not set(state_dict) & set(missing)
+
+
+def test_lora_state_dict_raises_on_missing_entries():
+    class DroppingWrapper(_StateDictWrapper):
+        def state_dict(self, *args, **kwargs):
+            state_dict = super().state_dict(*args, **kwargs)
+            del state_dict["proj.lora_B"]
+            return state_dict
+
+    with pytest.raises(RuntimeError, match="LoRA layers"):
+        lora_new.lora_state_dict(DroppingWrapper(_LoRAModel()))
+
+
+@pytest.mark.parametrize("fan_in_fan_out", [False, True])
+def test_merge_round_trip(fan_in_fan_out):
+    torch.manual_seed(0)
+    layer = lora_new.MergedLinearFull(16, 48, r=4, lora_alpha=8, enable_lora=[True], fan_in_fan_out=fan_in_fan_out)
+    # B starts as zeros, which would make merging a no-op
+    torch.nn.init.normal_(layer.lora_B)
+    weight = layer.weight.detach().clone()
+    x = torch.randn(2, 5, 16)
+
+    train_output = layer(x)
+    layer.eval()
+    assert layer.merged
+    assert not torch.equal(layer.weight, weight)
+    torch.testing.assert_close(layer(x), train_output)
+
+    layer.train()
+    assert not layer.merged
+    torch.testing.assert_close(layer.weight.detach(), weight)
+    torch.testing.assert_close(layer(x), train_output)
+
+
+@pytest.mark.parametrize(
+    "bias, trainable",
+    [
+        ("none", {"qkv.lora_A", "qkv.lora_B", "proj.lora_A", "proj.lora_B"}),
+        ("lora_only", {"qkv.lora_A", "qkv.lora_B", "proj.lora_A", "proj.lora_B", "proj.bias"}),
+        ("all", {"qkv.lora_A", "qkv.lora_B", "proj.lora_A", "proj.lora_B", "proj.bias", "head.bias"}),
+    ],
+)
+def test_mark_only_lora_as_trainable(bias, trainable):
+    model = _LoRAModel()
+    model.requires_grad_(True)
+    lora_new.mark_only_lora_as_trainable(model, bias=bias)
+    assert {n for n, p in model.named_parameters() if p.requires_grad} == trainable